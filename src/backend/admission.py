@@ -0,0 +1,164 @@
+# crop_disease/src/backend/admission.py
+from contextlib import contextmanager
+from dotenv import load_dotenv
+import threading
+import time
+import os
+
+# ---------------- ENV SETUP ----------------
+load_dotenv()
+
+# Inference slots running at once, and requests allowed to wait for a slot.
+# Slots share one model; this is safe because Grad-CAM captures activations
+# per call rather than through module hooks (see inference.GradCAM).
+MAX_CONCURRENT_INFERENCE = int(os.getenv("MAX_CONCURRENT_INFERENCE", "2"))
+MAX_INFERENCE_QUEUE = int(os.getenv("MAX_INFERENCE_QUEUE", "8"))
+# Seconds a queued request may wait for a slot before it is shed
+QUEUE_TIMEOUT = float(os.getenv("INFERENCE_QUEUE_TIMEOUT", "10"))
+# In-flight + queued requests at which Grad-CAM and TTA are dropped
+DEGRADE_THRESHOLD = int(os.getenv("DEGRADE_THRESHOLD", str(MAX_CONCURRENT_INFERENCE + 2)))
+
+# Per-user token bucket: sustained requests per minute and burst size
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "30"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "10"))
+MAX_TRACKED_CLIENTS = 10000
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is refused; carries the HTTP status and Retry-After seconds"""
+    def __init__(self, message, status_code, retry_after):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.retry_after = max(1, int(round(retry_after)))
+
+
+# ---------------- RATE LIMITING ----------------
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate            # tokens per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Take one token. Returns (allowed, seconds until a token is available)"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True, 0
+        return False, (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    def __init__(self, per_minute=RATE_LIMIT_PER_MINUTE, burst=RATE_LIMIT_BURST,
+                 max_clients=MAX_TRACKED_CLIENTS):
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _prune(self):
+        # Drop buckets that have refilled completely; they carry no state
+        now = time.monotonic()
+        full_after = self.burst / self.rate
+        stale = [key for key, bucket in self._buckets.items() if now - bucket.updated >= full_after]
+        for key in stale:
+            del self._buckets[key]
+
+    def check(self, key):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_clients:
+                    self._prune()
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+            allowed, retry_after = bucket.take()
+
+        if not allowed:
+            raise AdmissionRejected("Rate limit exceeded. Please slow down.", 429, retry_after)
+
+
+# ---------------- CONCURRENCY / QUEUE ----------------
+class AdmissionController:
+    def __init__(self, max_concurrent=MAX_CONCURRENT_INFERENCE, max_queue=MAX_INFERENCE_QUEUE,
+                 queue_timeout=QUEUE_TIMEOUT, degrade_threshold=DEGRADE_THRESHOLD):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.degrade_threshold = degrade_threshold
+
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._avg_service_time = 1.0  # EWMA, seconds
+        self._counters = {"admitted": 0, "shed": 0, "rate_limited": 0, "degraded": 0}
+
+    def _retry_after(self):
+        # Rough time for the current backlog to drain through the available slots
+        backlog = self._active + self._waiting + 1
+        return self._avg_service_time * backlog / self.max_concurrent
+
+    def _shed(self, message):
+        self._counters["shed"] += 1
+        return AdmissionRejected(message, 503, self._retry_after())
+
+    def record_rate_limited(self):
+        with self._cond:
+            self._counters["rate_limited"] += 1
+
+    @contextmanager
+    def admit(self):
+        """
+        Hold an inference slot for the duration of the block.
+        Yields True if expensive options (Grad-CAM, TTA) should be skipped.
+        """
+        with self._cond:
+            if self._active >= self.max_concurrent and self._waiting >= self.max_queue:
+                raise self._shed("Server is busy. Please retry shortly.")
+
+            degraded = self._active + self._waiting >= self.degrade_threshold
+            deadline = time.monotonic() + self.queue_timeout
+            self._waiting += 1
+            try:
+                while self._active >= self.max_concurrent:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise self._shed("Timed out waiting for an inference slot.")
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting -= 1
+
+            self._active += 1
+            self._counters["admitted"] += 1
+            if degraded:
+                self._counters["degraded"] += 1
+
+        started = time.monotonic()
+        try:
+            yield degraded
+        finally:
+            elapsed = time.monotonic() - started
+            with self._cond:
+                self._active -= 1
+                self._avg_service_time = 0.8 * self._avg_service_time + 0.2 * elapsed
+                self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                **self._counters,
+                "active": self._active,
+                "queued": self._waiting,
+                "max_concurrent": self.max_concurrent,
+                "max_queue": self.max_queue,
+                "avg_service_time": round(self._avg_service_time, 3)
+            }
+
+
+inference_admission = AdmissionController()
+rate_limiter = RateLimiter()
@@ -3,6 +3,7 @@ from flask import Flask, request, jsonify
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 import os, sys, json
+import uuid
 import jwt
 
 # Add model folder to path
@@ -12,7 +13,9 @@ from inference import predict
 # Import auth blueprint
 from auth import auth_bp, bcrypt
 # Import history blueprint
-from history import history_bp
+from history import history_bp, verify_token, save_prediction_async
+# Admission control for inference
+from admission import AdmissionRejected, inference_admission, rate_limiter
 
 # -----------------------------
 UPLOAD_FOLDER = "uploads"
@@ -23,7 +26,7 @@ if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=["Retry-After"])  # let the Dashboard honour 429/503 backoff
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 
 # Init bcrypt
@@ -46,10 +49,28 @@ except FileNotFoundError:
 def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def client_key():
+    """Rate-limit key: JWT user_id when authenticated, client IP otherwise"""
+    token = request.headers.get("Authorization")
+    if token:
+        user_id, error = verify_token(token)
+        if not error and user_id:
+            return f"user:{user_id}"
+    return f"ip:{request.remote_addr}"
+
+def form_flag(name):
+    return request.form.get(name, "").lower() in ("1", "true", "yes")
+
 # -----------------------------
 @app.route("/predict", methods=["POST"])
 def predict_crop():
     try:
+        try:
+            rate_limiter.check(client_key())
+        except AdmissionRejected:
+            inference_admission.record_rate_limited()
+            raise
+
         if "file" not in request.files:
             return jsonify({"error": "No file part"}), 400
 
@@ -57,13 +78,36 @@ def predict_crop():
         if file.filename == "":
             return jsonify({"error": "No selected file"}), 400
 
+        # Optional server-side save to history (saves the client a second upload)
+        save_to_history = form_flag("save")
+        user_id = None
+        if save_to_history:
+            token = request.headers.get("Authorization")
+            if not token:
+                return jsonify({"error": "No token provided"}), 401
+            user_id, error = verify_token(token)
+            if error:
+                return jsonify({"error": error}), 401
+
         if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
+            # Keep the upload in memory for history and give the temp file a unique
+            # name, so concurrent uploads with the same filename can't collide
+            image_bytes = file.read()
+            filename = f"{uuid.uuid4().hex}_{secure_filename(file.filename)}"
             filepath = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-            file.save(filepath)
+            with open(filepath, "wb") as f:
+                f.write(image_bytes)
 
-            # Get predictions from model (now includes gradcam_image)
-            result = predict(filepath, topk=3, include_gradcam=True)
+            # Get predictions from model. Grad-CAM covers top1, or every top-k entry
+            # when the client opts in with gradcam_topk=true.
+            # Under pressure Grad-CAM and TTA are dropped to keep latency bounded.
+            try:
+                with inference_admission.admit() as degraded:
+                    result = predict(filepath, topk=3, include_gradcam=not degraded, use_tta=not degraded,
+                                     gradcam_topk=form_flag("gradcam_topk"))
+            except AdmissionRejected:
+                os.remove(filepath)
+                raise
             top_preds = result['predictions']
             gradcam_image = result['gradcam_image']
 
@@ -89,6 +133,7 @@ def predict_crop():
 
             response = {
                 "success": True,
+                "degraded": degraded,
                 "gradcam_image": gradcam_image,  # Add Grad-CAM image
                 "top1": {
                     "class": top1_info["crop_name"],
@@ -102,25 +147,51 @@ def predict_crop():
             if len(top_preds) > 1:
                 response["top2"] = {
                     "class": top_preds[1]["class"],
-                    "confidence": round(top_preds[1]["confidence"], 4)
+                    "confidence": round(top_preds[1]["confidence"], 4),
+                    "gradcam_image": top_preds[1].get("gradcam_image")
                 }
 
             if len(top_preds) > 2:
                 response["top3"] = {
                     "class": top_preds[2]["class"],
-                    "confidence": round(top_preds[2]["confidence"], 4)
+                    "confidence": round(top_preds[2]["confidence"], 4),
+                    "gradcam_image": top_preds[2].get("gradcam_image")
                 }
 
+            if save_to_history:
+                # saved is "pending" (queued, not yet guaranteed), "saved" or "failed"
+                prediction_id, response["saved"] = save_prediction_async(user_id, {
+                    "filename": file.filename,
+                    "disease": response["top1"]["class"],
+                    "confidence": response["top1"]["confidence"],
+                    "reason": response["top1"]["reason"],
+                    "tips": response["top1"]["tips"],
+                    "fertilizer": response["top1"]["fertilizer"],
+                    "top2_class": response.get("top2", {}).get("class"),
+                    "top2_confidence": response.get("top2", {}).get("confidence"),
+                    "top3_class": response.get("top3", {}).get("class"),
+                    "top3_confidence": response.get("top3", {}).get("confidence")
+                }, image_bytes=image_bytes, mimetype=file.mimetype, thumbnail=form_flag("thumbnail"))
+                if prediction_id:
+                    response["prediction_id"] = prediction_id
+
             try:
                 os.remove(filepath)
             except:
                 pass
 
-            print("Response with Grad-CAM:", {**response, "gradcam_image": "base64_data..."})
+            print(f"Response: {response['top1']['class']} - {response['top1']['confidence']:.4f} "
+                  f"(Grad-CAM: {'yes' if gradcam_image else 'no'})")
             return jsonify(response)
         else:
             return jsonify({"error": "File type not allowed. Please use PNG, JPG, or JPEG."}), 400
 
+    except AdmissionRejected as e:
+        print(f"Request rejected ({e.status_code}): {e.message}")
+        response = jsonify({"error": e.message})
+        response.headers["Retry-After"] = str(e.retry_after)
+        return response, e.status_code
+
     except Exception as e:
         print(f"Error in prediction: {str(e)}")
         return jsonify({"error": f"Prediction failed: {str(e)}"}), 500
@@ -146,7 +217,11 @@ def test_model():
 
 @app.route("/health", methods=["GET"])
 def health_check():
-    return jsonify({"status": "healthy", "message": "Crop Disease API is running"})
+    return jsonify({
+        "status": "healthy",
+        "message": "Crop Disease API is running",
+        "admission": inference_admission.stats()
+    })
 
 # -----------------------------
 if __name__ == "__main__":
@@ -1,10 +1,19 @@
 # crop_disease/src/backend/history.py
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, Response, stream_with_context
 from pymongo import MongoClient
 import jwt
 import os
-from datetime import datetime
+import base64
+import csv
+import json
+import re
+import threading
+from io import BytesIO, StringIO
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from itertools import chain
 from bson.objectid import ObjectId
+from PIL import Image
 
 history_bp = Blueprint("history", __name__)
 
@@ -15,6 +24,40 @@ predictions_collection = db["predictions"]
 
 SECRET_KEY = os.environ.get("SECRET_KEY", "MYSECRETKEY")
 
+THUMBNAIL_SIZE = (256, 256)
+EXPORT_BATCH_SIZE = 200
+EXPORT_FIELDS = [
+    "prediction_id", "timestamp", "filename", "disease", "confidence",
+    "reason", "tips", "fertilizer", "top2_class", "top2_confidence",
+    "top3_class", "top3_confidence", "image_ref", "image_base64"
+]
+
+# Background writer so /predict can save history without waiting on MongoDB.
+# Each queued save holds the raw upload, so the backlog is bounded; when it is
+# full the save runs synchronously in the request instead.
+MAX_PENDING_SAVES = int(os.environ.get("MAX_PENDING_SAVES", "16"))
+_save_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="history-save")
+_pending_saves = threading.BoundedSemaphore(MAX_PENDING_SAVES)
+
+# Lets history listing/export walk a user's records newest-first without an
+# in-memory sort. Created on first use rather than at import, so the API can
+# start (and serve /predict) while MongoDB is unreachable.
+_history_index_ready = False
+_history_index_lock = threading.Lock()
+
+def ensure_history_index():
+    global _history_index_ready
+    if _history_index_ready:
+        return
+    with _history_index_lock:
+        if _history_index_ready:
+            return
+        try:
+            predictions_collection.create_index([("user_id", 1), ("timestamp", -1)])
+            _history_index_ready = True
+        except Exception as e:
+            print(f"Warning: could not create history index: {e}")
+
 def verify_token(token):
     """Helper function to verify JWT token"""
     try:
@@ -27,6 +70,75 @@ def verify_token(token):
     except Exception as e:
         return None, str(e)
 
+def build_prediction_doc(user_id, data):
+    """Build a history document from prediction fields"""
+    return {
+        "user_id": user_id,
+        "image_base64": data.get("image_base64"),
+        "filename": data.get("filename"),
+        "disease": data.get("disease"),
+        "confidence": data.get("confidence"),
+        "reason": data.get("reason"),
+        "tips": data.get("tips"),
+        "fertilizer": data.get("fertilizer"),
+        "top2_class": data.get("top2_class"),
+        "top2_confidence": data.get("top2_confidence"),
+        "top3_class": data.get("top3_class"),
+        "top3_confidence": data.get("top3_confidence"),
+        "timestamp": datetime.utcnow().isoformat()
+    }
+
+def encode_image_base64(image_bytes, mimetype, thumbnail=False):
+    """Encode uploaded image bytes as a data URL, optionally as a compact JPEG thumbnail"""
+    if thumbnail:
+        img = Image.open(BytesIO(image_bytes)).convert("RGB")
+        img.thumbnail(THUMBNAIL_SIZE)
+        buffer = BytesIO()
+        img.save(buffer, format="JPEG", quality=80)
+        image_bytes, mimetype = buffer.getvalue(), "image/jpeg"
+    return f"data:{mimetype};base64,{base64.b64encode(image_bytes).decode()}"
+
+def _insert_prediction(prediction_doc, image_bytes=None, mimetype=None, thumbnail=False):
+    try:
+        if image_bytes is not None:
+            prediction_doc["image_base64"] = encode_image_base64(image_bytes, mimetype, thumbnail)
+        predictions_collection.insert_one(prediction_doc)
+        return True
+    except Exception as e:
+        print(f"Error saving prediction {prediction_doc.get('_id')}: {str(e)}")
+        return False
+
+def _insert_prediction_queued(*args):
+    try:
+        _insert_prediction(*args)
+    finally:
+        _pending_saves.release()
+
+def save_prediction_async(user_id, data, image_bytes=None, mimetype=None, thumbnail=False):
+    """
+    Save a history record without waiting for MongoDB when the backlog allows.
+    When image_bytes is given, the image is encoded as part of the save.
+    Returns (prediction_id, status): status is "pending" when queued (the record
+    is not guaranteed to exist yet and may still fail), "saved" when written
+    synchronously, or "failed" with prediction_id None.
+    """
+    prediction_doc = build_prediction_doc(user_id, data)
+    prediction_doc["_id"] = ObjectId()
+    prediction_id = str(prediction_doc["_id"])
+
+    if _pending_saves.acquire(blocking=False):
+        try:
+            _save_executor.submit(_insert_prediction_queued, prediction_doc, image_bytes, mimetype, thumbnail)
+        except Exception:
+            _pending_saves.release()
+            raise
+        return prediction_id, "pending"
+
+    # Backlog full: write in the request so memory stays bounded
+    if _insert_prediction(prediction_doc, image_bytes, mimetype, thumbnail):
+        return prediction_id, "saved"
+    return None, "failed"
+
 # Save prediction to history
 @history_bp.route("/save", methods=["POST"])
 def save_prediction():
@@ -42,21 +154,7 @@ def save_prediction():
         data = request.get_json()
         
         # Create prediction document
-        prediction_doc = {
-            "user_id": user_id,
-            "image_base64": data.get("image_base64"),
-            "filename": data.get("filename"),
-            "disease": data.get("disease"),
-            "confidence": data.get("confidence"),
-            "reason": data.get("reason"),
-            "tips": data.get("tips"),
-            "fertilizer": data.get("fertilizer"),
-            "top2_class": data.get("top2_class"),
-            "top2_confidence": data.get("top2_confidence"),
-            "top3_class": data.get("top3_class"),
-            "top3_confidence": data.get("top3_confidence"),
-            "timestamp": datetime.utcnow().isoformat()
-        }
+        prediction_doc = build_prediction_doc(user_id, data)
         
         result = predictions_collection.insert_one(prediction_doc)
         
@@ -81,6 +179,7 @@ def get_history():
         return jsonify({"error": error}), 401
 
     try:
+        ensure_history_index()
         # Get all predictions for user, sorted by newest first
         cursor = predictions_collection.find(
             {"user_id": user_id}
@@ -170,4 +269,158 @@ def get_stats():
         })
 
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
\ No newline at end of file
+        return jsonify({"error": str(e)}), 500
+
+def _parse_export_bound(value, end=False):
+    """
+    Turn a start/end query value into a (operator, naive UTC ISO string) pair that
+    compares correctly with stored timestamps. Bare dates cover the whole day.
+    """
+    try:
+        day = date.fromisoformat(value)
+    except ValueError:
+        day = None
+
+    if day is not None:
+        bound = datetime.combine(day, datetime.min.time())
+        if end:
+            return "$lt", (bound + timedelta(days=1)).isoformat()
+        return "$gte", bound.isoformat()
+
+    bound = datetime.fromisoformat(value)
+    if bound.tzinfo is not None:
+        bound = bound.astimezone(timezone.utc).replace(tzinfo=None)
+    return ("$lte" if end else "$gte"), bound.isoformat()
+
+# Stream full history as NDJSON or CSV
+@history_bp.route("/export", methods=["GET"])
+def export_history():
+    token = request.headers.get("Authorization")
+    if not token:
+        return jsonify({"error": "No token provided"}), 401
+
+    user_id, error = verify_token(token)
+    if error:
+        return jsonify({"error": error}), 401
+
+    export_format = request.args.get("format", "ndjson").lower()
+    images = request.args.get("images", "none").lower()
+    if export_format not in ("ndjson", "csv"):
+        return jsonify({"error": "format must be 'ndjson' or 'csv'"}), 400
+    if images not in ("none", "inline", "ref"):
+        return jsonify({"error": "images must be 'none', 'inline' or 'ref'"}), 400
+
+    # Filters are pushed down into the MongoDB query
+    query = {"user_id": user_id}
+    start, end = request.args.get("start"), request.args.get("end")
+    try:
+        if start or end:
+            # Timestamps are stored as naive UTC ISO strings, so string ranges sort correctly
+            query["timestamp"] = {}
+            if start:
+                op, bound = _parse_export_bound(start)
+                query["timestamp"][op] = bound
+            if end:
+                op, bound = _parse_export_bound(end, end=True)
+                query["timestamp"][op] = bound
+    except ValueError:
+        return jsonify({"error": "start and end must be ISO dates or datetimes (e.g. 2026-10-19)"}), 400
+
+    disease = request.args.get("disease")
+    if disease:
+        query["disease"] = {"$regex": f"^{re.escape(disease)}$", "$options": "i"}
+
+    projection = None if images == "inline" else {"image_base64": 0}
+    fields = [f for f in EXPORT_FIELDS
+              if (f != "image_base64" or images == "inline") and (f != "image_ref" or images == "ref")]
+
+    ensure_history_index()
+
+    # Fetch the first batch before streaming so query errors still get a 500
+    cursor = predictions_collection.find(query, projection).sort("timestamp", -1).batch_size(EXPORT_BATCH_SIZE)
+    try:
+        first_doc = next(cursor, None)
+    except Exception as e:
+        cursor.close()
+        print(f"Error in export_history: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+    # Mid-stream failures can no longer change the status code, so they are
+    # reported in-band: an error record (NDJSON) or trailer line (CSV)
+    stream_errors = []
+
+    def rows():
+        docs = chain([first_doc], cursor) if first_doc is not None else cursor
+        try:
+            for doc in docs:
+                doc["prediction_id"] = str(doc.pop("_id"))
+                if images == "ref":
+                    doc["image_ref"] = f"/history/image/{doc['prediction_id']}"
+                yield {field: doc.get(field) for field in fields}
+        except Exception as e:
+            print(f"Error in export_history stream: {str(e)}")
+            stream_errors.append(str(e))
+        finally:
+            cursor.close()
+
+    def generate_ndjson():
+        for row in rows():
+            yield json.dumps(row, default=str) + "\n"
+        if stream_errors:
+            yield json.dumps({"error": f"Export incomplete: {stream_errors[0]}"}) + "\n"
+
+    def generate_csv():
+        buffer = StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=fields)
+        writer.writeheader()
+        for row in rows():
+            writer.writerow(row)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+        if stream_errors:
+            buffer.write(f"# ERROR: Export incomplete: {stream_errors[0]}\n")
+        yield buffer.getvalue()
+
+    if export_format == "csv":
+        body, mimetype = generate_csv(), "text/csv"
+    else:
+        body, mimetype = generate_ndjson(), "application/x-ndjson"
+
+    return Response(
+        stream_with_context(body),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename=history.{export_format}"}
+    )
+
+# Get the stored image for one prediction (referenced by exports)
+@history_bp.route("/image/<prediction_id>", methods=["GET"])
+def get_prediction_image(prediction_id):
+    token = request.headers.get("Authorization")
+    if not token:
+        return jsonify({"error": "No token provided"}), 401
+
+    user_id, error = verify_token(token)
+    if error:
+        return jsonify({"error": error}), 401
+
+    if not ObjectId.is_valid(prediction_id):
+        return jsonify({"error": f"Invalid prediction ID format: {prediction_id}"}), 400
+
+    try:
+        doc = predictions_collection.find_one(
+            {"_id": ObjectId(prediction_id), "user_id": user_id},
+            {"image_base64": 1}
+        )
+        if not doc or not doc.get("image_base64"):
+            return jsonify({"error": "Image not found or unauthorized"}), 404
+
+        # Stored as a data URL: data:<mimetype>;base64,<data>
+        header, _, data = doc["image_base64"].partition(",")
+        mimetype = header[5:].split(";")[0] if header.startswith("data:") else "application/octet-stream"
+        if not data:
+            data = header
+        return Response(base64.b64decode(data), mimetype=mimetype)
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
@@ -1,6 +1,7 @@
 # crop_disease/src/backend/model/inference.py
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torchvision import models, transforms
 from PIL import Image
 import numpy as np
@@ -37,60 +38,81 @@ NUM_TTA = 5
 TEMPERATURE = 1.0
 
 # -----------------------------
-# GRAD-CAM CLASS (EXACT FROM NOTEBOOK)
+# GRAD-CAM CLASS
 # -----------------------------
 class GradCAM:
+    """
+    Grad-CAM without module hooks: the model is run by hand so the target layer's
+    activations belong to this call only. The shared model can then serve other
+    requests (TTA passes, other Grad-CAMs) concurrently without clobbering them.
+    """
     def __init__(self, model, target_layer):
         self.model = model
         self.target_layer = target_layer
-        self.gradients = None
-        self.activations = None
-        self._register_hooks()
 
-    def _register_hooks(self):
-        def forward_hook(module, inp, out):
-            self.activations = out.detach()
+    def _forward_with_activations(self, input_tensor):
+        # Mirrors MobileNetV3.forward: features -> avgpool -> flatten -> classifier
+        activations = None
+        x = input_tensor
+        for block in self.model.features:
+            if any(m is self.target_layer for m in block.modules()):
+                for sub in block:
+                    x = sub(x)
+                    if sub is self.target_layer:
+                        activations = x
+            else:
+                x = block(x)
 
-        def backward_hook(module, grad_input, grad_output):
-            self.gradients = grad_output[0].detach()
+        if activations is None:
+            raise ValueError("Target layer must be a direct child of a block in model.features")
 
-        # Forward hook
-        self.target_layer.register_forward_hook(forward_hook)
-        # Backward hook (full, works in PyTorch 2+)
-        try:
-            self.target_layer.register_full_backward_hook(backward_hook)
-        except:
-            self.target_layer.register_backward_hook(backward_hook)
+        x = self.model.avgpool(x)
+        x = torch.flatten(x, 1)
+        return self.model.classifier(x), activations
 
-    def generate(self, input_tensor, class_idx=None, gamma=0.7):
-        # Model stays in eval mode, but we need gradients
-        output = self.model(input_tensor)
+    def generate_batch(self, input_tensor, class_indices, gamma=0.7):
+        """
+        Grad-CAM for several classes from a single forward pass.
+        Gradients of all k target scores are computed in one batched backward call,
+        so every heatmap is built from the same activations.
+        """
+        output, activations = self._forward_with_activations(input_tensor)
 
-        if class_idx is None:
-            class_idx = output.argmax(dim=1).item()
+        class_indices = [int(c) for c in class_indices]
+        scores = output[0, class_indices]  # (k,)
+        k = len(class_indices)
 
-        self.model.zero_grad()
-        score = output[0, class_idx]
-        score.backward(retain_graph=True)
-
-        # Get hooked data
-        gradients = self.gradients.cpu().numpy()[0]      # (C, H, W)
-        activations = self.activations.cpu().numpy()[0]  # (C, H, W)
+        # One one-hot row per target score; autograd vmaps the backward over rows
+        grad_outputs = torch.eye(k, dtype=scores.dtype, device=scores.device)
+        try:
+            gradients, = torch.autograd.grad(
+                scores, activations, grad_outputs=grad_outputs,
+                retain_graph=True, is_grads_batched=True
+            )
+        except RuntimeError:
+            # Some ops lack batching rules on older PyTorch; fall back to k backward
+            # calls that still share the same forward graph
+            gradients = torch.stack([
+                torch.autograd.grad(scores[i], activations, retain_graph=True)[0]
+                for i in range(k)
+            ])
 
-        # Global average pooling on gradients
-        weights = gradients.mean(axis=(1, 2))  # (C,)
-        cam = np.zeros(activations.shape[1:], dtype=np.float32)
+        gradients = gradients[:, 0].detach()   # (k, C, H, W)
+        activations = activations.detach()[0]  # (C, H, W)
 
-        for i, w in enumerate(weights):
-            cam += w * activations[i]
+        # Global average pooling on gradients, weighted sum over channels
+        weights = gradients.mean(dim=(2, 3))                          # (k, C)
+        cams = torch.einsum("kc,chw->khw", weights, activations)      # (k, H, W)
+        cams = torch.relu(cams).unsqueeze(1)
+        cams = F.interpolate(cams, size=(IMG_SIZE, IMG_SIZE), mode="bilinear", align_corners=False)
+        cams = cams.flatten(1)
 
-        cam = np.maximum(cam, 0)
-        cam = cv2.resize(cam, (224, 224))
-        cam = cam - cam.min()
-        if cam.max() > 0:
-            cam = cam / cam.max()
-        cam = np.power(cam, gamma)  # gamma correction
-        return cam, class_idx
+        cams = cams - cams.min(dim=1, keepdim=True).values
+        maxes = cams.max(dim=1, keepdim=True).values
+        cams = torch.where(maxes > 0, cams / maxes.clamp_min(1e-12), cams)
+        cams = cams.pow(gamma)  # gamma correction
+        cams = cams.view(k, IMG_SIZE, IMG_SIZE).cpu().numpy().astype(np.float32)
+        return cams, class_indices
 
 # -----------------------------
 # GET LAST CONV LAYER (EXACT FROM NOTEBOOK)
@@ -105,46 +127,44 @@ def get_last_conv_layer(model):
     raise ValueError("No Conv2d layer found in model.features!")
 
 # -----------------------------
-# GENERATE GRAD-CAM OVERLAY (EXACT FROM NOTEBOOK)
+# GENERATE GRAD-CAM OVERLAYS (NOTEBOOK BLENDING, BATCHED)
 # -----------------------------
-def generate_gradcam_overlay(model, input_tensor, orig_img_pil, class_idx):
+def _encode_png_base64(img_np):
+    buffer = BytesIO()
+    Image.fromarray(img_np).save(buffer, format='PNG')
+    img_str = base64.b64encode(buffer.getvalue()).decode()
+    return f"data:image/png;base64,{img_str}"
+
+def generate_gradcam_overlays(model, input_tensor, orig_img_pil, class_indices):
     """
-    Generate Grad-CAM heatmap overlay - matches notebook implementation exactly
+    Generate Grad-CAM overlays for every class in class_indices from one forward pass.
+    Returns a list of base64 PNG data URLs aligned with class_indices.
     """
+    k = len(class_indices)
     try:
         target_layer = get_last_conv_layer(model)
-        print(f"Using target layer: {target_layer}")
-        
-        # Create GradCAM and generate heatmap
-        gradcam = GradCAM(model, target_layer)
-        cam, _ = gradcam.generate(input_tensor, class_idx=class_idx)
-        
-        # Prepare original image (exactly as in notebook)
-        orig_np = np.array(orig_img_pil.resize((224, 224))).astype(np.float32) / 255.0
-        
-        # Overlay on original image (EXACT notebook code)
-        heatmap = cv2.applyColorMap(np.uint8(255 * cam), cv2.COLORMAP_JET)
-        heatmap = cv2.cvtColor(heatmap, cv2.COLOR_BGR2RGB) / 255.0
-        overlay = 0.5 * heatmap + 0.5 * orig_np
-        overlay = overlay / overlay.max()
-        
-        # Convert to uint8 for image encoding
-        overlay_img = np.uint8(255 * overlay)
-        
-        # Convert to base64
-        overlay_pil = Image.fromarray(overlay_img)
-        buffer = BytesIO()
-        overlay_pil.save(buffer, format='PNG')
-        img_str = base64.b64encode(buffer.getvalue()).decode()
-        
-        print(f"Grad-CAM generated successfully for class {class_idx}")
-        return f"data:image/png;base64,{img_str}"
-    
+        cams, _ = GradCAM(model, target_layer).generate_batch(input_tensor, class_indices)
+
+        orig_np = np.array(orig_img_pil.resize((IMG_SIZE, IMG_SIZE))).astype(np.float32) / 255.0
+
+        # Colormap all k heatmaps in one call by stacking them into a single strip
+        strip = np.uint8(255 * cams).reshape(k * IMG_SIZE, IMG_SIZE)
+        heatmaps = cv2.applyColorMap(strip, cv2.COLORMAP_JET)
+        heatmaps = cv2.cvtColor(heatmaps, cv2.COLOR_BGR2RGB).reshape(k, IMG_SIZE, IMG_SIZE, 3) / 255.0
+
+        overlays = 0.5 * heatmaps + 0.5 * orig_np[None]
+        overlays = overlays / overlays.max(axis=(1, 2, 3), keepdims=True)
+        overlay_imgs = np.uint8(255 * overlays)
+
+        images = [_encode_png_base64(img) for img in overlay_imgs]
+        print(f"Grad-CAM generated successfully for classes {list(class_indices)}")
+        return images
+
     except Exception as e:
         print(f"Error generating Grad-CAM: {e}")
         import traceback
         traceback.print_exc()
-        return None
+        return [None] * k
 
 # -----------------------------
 # MODEL LOADER
@@ -198,9 +218,10 @@ tta_tfms = transforms.Compose([
 # -----------------------------
 _model = None
 
-def predict(image_path, topk=3, include_gradcam=True):
+def predict(image_path, topk=3, include_gradcam=True, use_tta=True, gradcam_topk=False):
     """
-    Predict crop disease from image with Test Time Augmentation (TTA) and Grad-CAM
+    Predict crop disease from image with Test Time Augmentation (TTA) and Grad-CAM.
+    Grad-CAM covers the top-1 class, or every top-k class when gradcam_topk is set.
     """
     global _model
     
@@ -222,8 +243,8 @@ def predict(image_path, topk=3, include_gradcam=True):
             probs = torch.softmax(outputs, dim=1).cpu().numpy()[0]
             all_probs.append(probs)
 
-        # TTA predictions
-        for i in range(NUM_TTA):
+        # TTA predictions (skipped when degraded under load)
+        for i in range(NUM_TTA if use_tta else 0):
             aug_tensor = tta_tfms(img).unsqueeze(0).to(DEVICE)
             with torch.no_grad():
                 outputs = _model(aug_tensor) / TEMPERATURE
@@ -244,17 +265,21 @@ def predict(image_path, topk=3, include_gradcam=True):
                 "confidence": float(final_probs[idx])
             })
         
-        # Generate Grad-CAM for top prediction
-        gradcam_image = None
+        # Generate Grad-CAM for the top prediction, or all top-k in one pass
+        gradcam_images = [None] * len(sorted_idx)
         if include_gradcam:
-            top_class_idx = sorted_idx[0]
-            print(f"Generating Grad-CAM for class index {top_class_idx} ({class_names[top_class_idx]})")
+            gradcam_idx = sorted_idx if gradcam_topk else sorted_idx[:1]
+            print(f"Generating Grad-CAM for class indices {list(gradcam_idx)} "
+                  f"({', '.join(class_names[i] for i in gradcam_idx)})")
             
             # Create NEW tensor for Grad-CAM (with gradients enabled)
             input_tensor_gradcam = base_tfms(img).unsqueeze(0).to(DEVICE)
             input_tensor_gradcam.requires_grad_(True)  # Enable gradients
             
-            gradcam_image = generate_gradcam_overlay(_model, input_tensor_gradcam, img, top_class_idx)
+            gradcam_images[:len(gradcam_idx)] = generate_gradcam_overlays(_model, input_tensor_gradcam, img, gradcam_idx)
+
+        for result, gradcam_img in zip(results, gradcam_images):
+            result["gradcam_image"] = gradcam_img
         
         print("Prediction Results:")
         for i, result in enumerate(results, 1):
@@ -262,7 +287,7 @@ def predict(image_path, topk=3, include_gradcam=True):
         
         return {
             "predictions": results,
-            "gradcam_image": gradcam_image
+            "gradcam_image": gradcam_images[0] if gradcam_images else None
         }
         
     except Exception as e:
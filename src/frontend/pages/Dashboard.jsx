@@ -1,6 +1,9 @@
 // crop_disease/src/frontend/pages/Dashboard.jsx
 import React, { useState } from "react";
 
+// Retries per image when the server rate-limits or sheds the request
+const MAX_RETRIES = 5;
+
 const Dashboard = () => {
   const [selectedFiles, setSelectedFiles] = useState([]);
   const [predictions, setPredictions] = useState([]);
@@ -9,6 +12,7 @@ const Dashboard = () => {
   const [processingFile, setProcessingFile] = useState("");
   const [uploadMode, setUploadMode] = useState("single");
   const [savingStatus, setSavingStatus] = useState({}); // Track save status per prediction
+  const [autoSave, setAutoSave] = useState(false); // Save scans to history server-side
 
   const token = localStorage.getItem("token");
 
@@ -168,16 +172,47 @@ const Dashboard = () => {
 
       const formData = new FormData();
       formData.append("file", fileObj.file);
+      // Ask for heatmaps of the alternative diagnoses too
+      formData.append("gradcam_topk", "true");
+      // With auto-save on, the server saves the scan to history from this upload,
+      // so the image is not sent a second time to /history/save
+      if (token && autoSave) {
+        formData.append("save", "true");
+      }
 
       try {
-        const res = await fetch("http://127.0.0.1:5000/predict", {
-          method: "POST",
-          body: formData,
-        });
-
-        if (!res.ok) throw new Error("Network response not ok");
+        // The server answers 429 (rate limited) or 503 (busy) with Retry-After;
+        // wait and retry so large batches complete instead of failing part-way
+        let res;
+        for (let attempt = 0; ; attempt++) {
+          res = await fetch("http://127.0.0.1:5000/predict", {
+            method: "POST",
+            headers: token ? { Authorization: `Bearer ${token}` } : {},
+            body: formData,
+          });
+          if ((res.status !== 429 && res.status !== 503) || attempt >= MAX_RETRIES) break;
+
+          const retryAfter = parseInt(res.headers.get("Retry-After"), 10) || 5;
+          setProcessingFile(
+            `${fileObj.file.name} (${
+              res.status === 429 ? "rate limited" : "server busy"
+            }, retrying in ${retryAfter}s)`
+          );
+          await new Promise((resolve) => setTimeout(resolve, retryAfter * 1000));
+          setProcessingFile(fileObj.file.name);
+        }
+
+        if (!res.ok) {
+          const data = await res.json().catch(() => ({}));
+          throw new Error(data.error || "Network response not ok");
+        }
         const data = await res.json();
 
+        // "pending" means the save is queued on the server and may still fail
+        if (data.saved === "pending" || data.saved === "saved") {
+          setSavingStatus((prev) => ({ ...prev, [fileObj.id]: data.saved }));
+        }
+
         results.push({
           ...fileObj,
           prediction: data,
@@ -196,7 +231,7 @@ const Dashboard = () => {
         results.push({
           ...fileObj,
           status: "error",
-          error: "Analysis failed",
+          error: err.message,
         });
 
         setSelectedFiles((prev) =>
@@ -258,6 +293,8 @@ const Dashboard = () => {
             <span>Saving...</span>
           </span>
         );
+      case "pending":
+        return <span>⏳ Save queued</span>;
       case "saved":
         return <span>✓ Saved</span>;
       case "error":
@@ -320,6 +357,17 @@ const Dashboard = () => {
                   📚 Batch Upload
                 </button>
               </div>
+              {token && (
+                <label className="flex items-center space-x-2 text-gray-700 font-medium cursor-pointer">
+                  <input
+                    type="checkbox"
+                    checked={autoSave}
+                    onChange={(e) => setAutoSave(e.target.checked)}
+                    className="w-4 h-4 accent-emerald-600"
+                  />
+                  <span>💾 Auto-save to History</span>
+                </label>
+              )}
             </div>
           </div>
         </div>
@@ -494,7 +542,8 @@ const Dashboard = () => {
                         Analysis Failed
                       </h3>
                       <p className="text-red-600">
-                        Unable to process this image. Please try again.
+                        {result.error ||
+                          "Unable to process this image. Please try again."}
                       </p>
                     </div>
                   </div>
@@ -639,6 +688,7 @@ const Dashboard = () => {
                               onClick={() => savePrediction(result)}
                               disabled={
                                 savingStatus[result.id] === "saving" ||
+                                savingStatus[result.id] === "pending" ||
                                 savingStatus[result.id] === "saved"
                               }
                               className={`w-full px-6 py-3 rounded-xl font-semibold transition-all duration-300 shadow-lg hover:shadow-xl transform hover:-translate-y-0.5 disabled:opacity-50 disabled:cursor-not-allowed ${
@@ -674,7 +724,14 @@ const Dashboard = () => {
                                     </div>
                                   </div>
                                 </div>
-                                <div className="text-right">
+                                <div className="flex items-center space-x-3">
+                                  {result.prediction.top2.gradcam_image && (
+                                    <img
+                                      src={result.prediction.top2.gradcam_image}
+                                      alt={`Grad-CAM for ${result.prediction.top2.class}`}
+                                      className="w-16 h-16 object-cover rounded-lg border border-gray-200"
+                                    />
+                                  )}
                                   <span className="px-3 py-1 bg-blue-100 text-blue-700 rounded-full text-sm font-semibold">
                                     {(
                                       result.prediction.top2.confidence * 100
@@ -699,7 +756,14 @@ const Dashboard = () => {
                                     </div>
                                   </div>
                                 </div>
-                                <div className="text-right">
+                                <div className="flex items-center space-x-3">
+                                  {result.prediction.top3.gradcam_image && (
+                                    <img
+                                      src={result.prediction.top3.gradcam_image}
+                                      alt={`Grad-CAM for ${result.prediction.top3.class}`}
+                                      className="w-16 h-16 object-cover rounded-lg border border-gray-200"
+                                    />
+                                  )}
                                   <span className="px-3 py-1 bg-purple-100 text-purple-700 rounded-full text-sm font-semibold">
                                     {(
                                       result.prediction.top3.confidence * 100